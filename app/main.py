@@ -3,17 +3,20 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 from contextlib import asynccontextmanager
-import uvicorn
 import logging
-import json
+import orjson
 import time
 import re
-import base64
+import binascii
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from collections import deque
+from typing import AsyncIterator, List, Optional, Tuple
+import aiohttp
 import edge_tts
 from app.models import ChatRequest, ChatResponse, TTSRequest
 
@@ -23,22 +26,15 @@ RATE_LIMIT_MESSAGE = (
     "Please try again later."
 )
 
-def _is_rate_limit_error(exc: Exception) -> bool:
-    """True if the exception is a Groq rate limit (429 / tokens per day)."""
-    msg = str(exc).lower()
-    return "429" in str(exc) or "rate limit" in msg or "tokens per day" in msg
-
-
 from app.services.vector_store import VectorStoreService
-from app.services.groq_service import GroqService, AllGroqApisFailedError
+from app.services.groq_service import GroqService, AllGroqApisFailedError, is_rate_limit_error
 from app.services.realtime_service import RealtimeGroqService
-from app.services.chat_service import ChatService
+from app.services.chat_service import ChatService, AUTOSAVE_INTERVAL_SECONDS
 from config import (
-    VECTOR_STORE_DIR, GROQ_API_KEYS, GROQ_MODEL, TAVILY_API_KEY,
+    GROQ_API_KEYS, GROQ_MODEL, TAVILY_API_KEY,
     EMBEDDING_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, MAX_CHAT_HISTORY_TURNS,
     ASSISTANT_NAME, TTS_VOICE, TTS_RATE
 )
-from langchain_community.vectorstores import FAISS
 
 
 # --------------------------------------------------
@@ -81,6 +77,19 @@ def print_title():
     """
     print(title)
 
+async def _autosave_sessions():
+    """Periodically write sessions changed since the last flush, off the request path."""
+    while True:
+        await asyncio.sleep(AUTOSAVE_INTERVAL_SECONDS)
+        if not chat_service:
+            continue
+        try:
+            await chat_service.flush_dirty_sessions()
+        except Exception as e:
+            # Keep the loop alive: /chat and /chat/realtime rely on it to reach disk.
+            logger.error("[AUTOSAVE] Flush failed: %s", e, exc_info=True)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global vector_store_service, groq_service, realtime_service, chat_service
@@ -94,7 +103,7 @@ async def lifespan(app: FastAPI):
     logger.info("[CONFIG] Groq API keys loaded: %s", len(GROQ_API_KEYS))
     logger.info("[CONFIG] Tavily API key: %s", "configured" if TAVILY_API_KEY else "NOT SET")
     logger.info("[CONFIG] Embedding model: %s", EMBEDDING_MODEL)
-    logger.info("[CONFIG] Chunk size: %d | Overlap: %d | Max history turns: %d",
+    logger.info("[CONFIG] Chunk size: %d tokens | Overlap: %d tokens | Max history turns: %d",
                 CHUNK_SIZE, CHUNK_OVERLAP, MAX_CHAT_HISTORY_TURNS)
 
     try:
@@ -128,9 +137,14 @@ async def lifespan(app: FastAPI):
         logger.info("Docs: http://localhost:8000/docs")
         logger.info("=" * 60)
 
+        autosave_task = asyncio.create_task(_autosave_sessions())
+
         yield
 
         logger.info("\nShutting down J.A.R.V.I.S...")
+        autosave_task.cancel()
+        if _tts_session is not None:
+            await _tts_session.aclose()
         if chat_service:
             for session_id in list(chat_service.sessions.keys()):
                 chat_service.save_chat_session(session_id)
@@ -207,7 +221,6 @@ async def chat(request: ChatRequest):
     try:
         session_id = chat_service.get_or_create_session(request.session_id)
         response_text = chat_service.process_message(session_id, request.message)
-        chat_service.save_chat_session(session_id)
         logger.info("[API /chat] Done | session_id=%s | response_len=%d", session_id[:12], len(response_text))
         return ChatResponse(response=response_text, session_id=session_id)
 
@@ -220,7 +233,7 @@ async def chat(request: ChatRequest):
         raise HTTPException(status_code=503, detail=str(e))
 
     except Exception as e:
-        if _is_rate_limit_error(e):
+        if is_rate_limit_error(e):
             logger.warning("[API /chat] Rate limit hit: %s", e)
             raise HTTPException(status_code=429, detail=RATE_LIMIT_MESSAGE)
         logger.error("[API /chat] Error: %s", e, exc_info=True)
@@ -235,158 +248,311 @@ _SPLIT_RE = re.compile(r"(?<=[.!?,;:])\s+")
 _MIN_WORDS_FIRST = 2
 _MIN_WORDS = 3
 _MERGE_IF_WORDS = 2
+_TTS_BATCH_CHARS = 200
+_TTS_TERMINAL_PUNCT = (".", "!", "?")
 
 
-def _split_sentences(buf: str):
-    """Split text into sentences, keeping short fragments for next chunk"""
-    parts = _SPLIT_RE.split(buf)
-    if len(parts) <= 1:
-        return [], buf
-
-    raw = [p.strip() for p in parts[:-1] if p.strip()]
+def _split_sentences(buf: str) -> Tuple[List[Tuple[str, int]], str]:
+    """Split text into (sentence, word_count) pairs, keeping short fragments for next chunk"""
     sentences = []
-    pending = ""
+    start = len(buf) - len(buf.lstrip())
+    pending_start = None
 
-    for s in raw:
-        if pending:
-            s = (pending + " " + s).strip()
-            pending = ""
+    for m in _SPLIT_RE.finditer(buf):
+        seg_start = start if pending_start is None else pending_start
+        start = m.end()
+        s = buf[seg_start:m.start()]
+        wc = len(s.split())
 
         min_req = _MIN_WORDS_FIRST if not sentences else _MIN_WORDS
-        if len(s.split()) < min_req:
-            pending = s
+        if wc < min_req:
+            pending_start = seg_start
             continue
 
-        sentences.append(s)
+        pending_start = None
+        sentences.append((s, wc))
 
-    remaining = (pending + " " + parts[-1].strip() if pending else parts[-1].strip())
+    remaining = buf[start if pending_start is None else pending_start:]
     return sentences, remaining
 
 
-def _merge_short(sentences):
+def _merge_short(sentences: List[Tuple[str, int]]) -> List[Tuple[str, int]]:
     if not sentences:
         return []
 
     merged = []
     i = 0
     while i < len(sentences):
-        cur = sentences[i]
+        cur, cur_wc = sentences[i]
         j = i + 1
-        while j < len(sentences) and len(sentences[j].split()) <= _MERGE_IF_WORDS:
-            cur = (cur + " " + sentences[j]).strip()
+        while j < len(sentences) and sentences[j][1] <= _MERGE_IF_WORDS:
+            cur = (cur + " " + sentences[j][0]).strip()
+            cur_wc += sentences[j][1]
             j += 1
-        merged.append(cur)
+        merged.append((cur, cur_wc))
         i = j
     return merged
 
 
-def _generate_tts_sync(text: str, voice: str, rate: str) -> bytes:
-    async def _inner():
-        communicate = edge_tts.Communicate(text=text, voice=voice, rate=rate)
-        parts = []
+class _KeepOpenConnector(aiohttp.TCPConnector):
+    """edge-tts closes the connector together with its ClientSession; keep it open until aclose()."""
+
+    async def close(self, *, abort_ssl: bool = False) -> None:
+        return None
+
+    async def aclose(self) -> None:
+        await super().close()
+
+
+class TTSSession:
+    """Process-wide TTS context. Every synthesis reuses one connector and its DNS cache.
+
+    edge-tts does not expose its websocket, so each synthesis still opens its own socket.
+    """
+
+    def __init__(self, voice: str, rate: str):
+        self.voice = voice
+        self.rate = rate
+        self._connector: Optional[_KeepOpenConnector] = None
+
+    async def stream(self, text: str) -> AsyncIterator[bytes]:
+        """Yield MP3 frames as edge-tts delivers them, so playback can start before synthesis ends."""
+        if self._connector is None:
+            self._connector = _KeepOpenConnector(ttl_dns_cache=300)
+        communicate = edge_tts.Communicate(
+            text=text, voice=self.voice, rate=self.rate, connector=self._connector
+        )
         async for chunk in communicate.stream():
             if chunk["type"] == "audio":
-                parts.append(chunk["data"])
-        return b"".join(parts)
-    return asyncio.run(_inner())
+                yield chunk["data"]
+
+    async def synthesize(self, text: str) -> bytes:
+        return b"".join([part async for part in self.stream(text)])
+
+    async def aclose(self):
+        if self._connector is not None:
+            await self._connector.aclose()
+            self._connector = None
+
 
+_tts_session: Optional[TTSSession] = None
 
-_tts_pool = ThreadPoolExecutor(max_workers=4)
 
+def _get_tts_session() -> TTSSession:
+    global _tts_session
+    if _tts_session is None:
+        _tts_session = TTSSession(TTS_VOICE, TTS_RATE)
+    return _tts_session
 
-def _stream_generator(session_id: str, chunk_iter, is_realtime: bool, tts_enabled: bool = False):
-    yield f"data: {json.dumps({'session_id': session_id, 'chunk': '', 'done': False})}\n\n"
 
-    buffer = ""
-    held = None
-    is_first = True
-    audio_queue = []
+_ITER_DONE = object()
+# Items the worker may run ahead of the consumer before it blocks (backpressure).
+_ITER_MAX_PENDING = 64
 
-    def _submit(text):
-        if not text.strip():
+
+async def _iterate_in_thread(sync_iter):
+    """Drive a blocking iterator in a worker thread and yield its items on the event loop.
+
+    Closing this generator (client disconnect) stops the worker at the next item and
+    closes sync_iter, so an upstream LLM stream is not read to the end for nobody.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+    slots = threading.Semaphore(_ITER_MAX_PENDING)
+
+    def _produce():
+        error = None
+        try:
+            for item in sync_iter:
+                slots.acquire()
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+        except Exception as exc:
+            error = exc
+        if stop.is_set():
+            close = getattr(sync_iter, "close", None)
+            if close is not None:
+                close()
             return
-        audio_queue.append((_tts_pool.submit(_generate_tts_sync, text, TTS_VOICE, TTS_RATE), text))
-
-    def _drain_ready():
-        events = []
-        while audio_queue and audio_queue[0][0].done():
-            fut, sent = audio_queue.pop(0)
-            try:
-                audio = fut.result()
-                b64 = base64.b64encode(audio).decode("ascii")
-                events.append(f"data: {json.dumps({'audio': b64, 'sentence': sent})}\n\n")
-            except Exception as exc:
-                logger.warning("[TTS-INLINE] Failed for '%s': %s", sent[:40], exc)
-        return events
+        loop.call_soon_threadsafe(queue.put_nowait, (_ITER_DONE, error))
 
+    # Starlette's anyio threadpool (40 threads), as before: each live stream holds a thread for
+    # its whole length, which would starve the loop's small default executor.
+    producer = asyncio.create_task(run_in_threadpool(_produce))
+    try:
+        while True:
+            item, exc = await queue.get()
+            if item is _ITER_DONE:
+                break
+            slots.release()
+            yield item
+        await producer
+        if exc is not None:
+            raise exc
+    finally:
+        stop.set()
+        # Wake a worker blocked on a full queue so it sees the stop flag.
+        slots.release()
+
+
+def _event_frame(payload: dict) -> bytes:
+    """SSE frame for a control event (session id, search results, done/error)."""
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+
+def _chunk_frame(chunk: str) -> str:
+    """SSE frame for a text chunk; only the chunk body is JSON-encoded."""
+    return f'data: {{"chunk": {orjson.dumps(chunk).decode()}, "done": false}}\n\n'
+
+
+def _audio_frame(audio: bytes, sentence: str) -> bytes:
+    """SSE frame for a TTS clip, assembled as bytes so the base64 payload is never decoded to str."""
+    b64 = binascii.b2a_base64(audio, newline=False)
+    return b'data: {"audio": "' + b64 + b'", "sentence": ' + orjson.dumps(sentence) + b'}\n\n'
+
+
+async def _stream_generator(session_id: str, chunk_iter, is_realtime: bool, tts_enabled: bool = False):
+    yield _event_frame({"session_id": session_id, "chunk": "", "done": False})
+
+    tts_session = _get_tts_session()
+    audio_queue = deque()
+    # Set by TTS task completion; audio_queue keeps submission order so clips still go out in order.
+    audio_ready = asyncio.Event()
+    chunks = _iterate_in_thread(chunk_iter).__aiter__()
+    next_chunk = asyncio.ensure_future(chunks.__anext__())
+    audio_wait = None
     try:
-        for chunk in chunk_iter:
-            if isinstance(chunk, dict) and "_search_results" in chunk:
-                yield f"data: {json.dumps({'search_results': chunk['_search_results']})}\n\n"
-                continue
+        buffer = ""
+        held = None
+        is_first = True
+        pending_tts = []
+
+        def _flush_tts():
+            if not pending_tts:
+                return
+            text = " ".join(pending_tts)
+            pending_tts.clear()
+            task = asyncio.create_task(tts_session.synthesize(text))
+            task.add_done_callback(lambda _t: audio_ready.set())
+            audio_queue.append((task, text))
+
+        def _submit(text):
+            text = text.strip()
+            if not text:
+                return
+            pending_tts.append(text)
+            # Flush right away while nothing is in flight so first audio is not delayed.
+            if (not audio_queue or text.endswith(_TTS_TERMINAL_PUNCT)
+                    or sum(len(t) for t in pending_tts) >= _TTS_BATCH_CHARS):
+                _flush_tts()
+
+        def _drain_ready():
+            events = []
+            while audio_queue and audio_queue[0][0].done():
+                task, sent = audio_queue.popleft()
+                try:
+                    events.append(_audio_frame(task.result(), sent))
+                except Exception as exc:
+                    logger.warning("[TTS-INLINE] Failed for '%s': %s", sent[:40], exc)
+            return events
 
-            yield f"data: {json.dumps({'chunk': chunk, 'done': False})}\n\n"
+        try:
+            while True:
+                if tts_enabled and audio_wait is None:
+                    audio_wait = asyncio.ensure_future(audio_ready.wait())
+                waiters = {next_chunk, audio_wait} if audio_wait else {next_chunk}
+                done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+
+                if audio_wait in done:
+                    audio_ready.clear()
+                    audio_wait = None
+                    for ev in _drain_ready():
+                        yield ev
+                    # Nothing in flight any more: don't hold batched text until the next sentence.
+                    if not audio_queue and pending_tts:
+                        _flush_tts()
+
+                if next_chunk not in done:
+                    continue
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    break
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+
+                if isinstance(chunk, dict) and "_search_results" in chunk:
+                    yield _event_frame({"search_results": chunk["_search_results"]})
+                    continue
 
-            if not tts_enabled:
-                continue
+                yield _chunk_frame(chunk)
 
-            for ev in _drain_ready():
-                yield ev
+                if not tts_enabled:
+                    continue
 
-            buffer += chunk
-            sentences, buffer = _split_sentences(buffer)
-            sentences = _merge_short(sentences)
+                buffer += chunk
+                sentences, buffer = _split_sentences(buffer)
+                sentences = _merge_short(sentences)
 
-            if held and sentences and len(sentences[0].split()) <= _MERGE_IF_WORDS:
-                held = (held + " " + sentences[0]).strip()
-                sentences = sentences[1:]
+                if held and sentences and sentences[0][1] <= _MERGE_IF_WORDS:
+                    held = (held + " " + sentences[0][0]).strip()
+                    sentences = sentences[1:]
 
-            for i, sent in enumerate(sentences):
-                min_w = _MIN_WORDS_FIRST if is_first else _MIN_WORDS
-                if len(sent.split()) < min_w:
-                    continue
+                for i, (sent, wc) in enumerate(sentences):
+                    min_w = _MIN_WORDS_FIRST if is_first else _MIN_WORDS
+                    if wc < min_w:
+                        continue
 
-                is_last = (i == len(sentences) - 1)
+                    is_last = (i == len(sentences) - 1)
 
-                if held:
-                    _submit(held)
-                    held = None
-                    is_first = False
+                    if held:
+                        _submit(held)
+                        held = None
+                        is_first = False
 
-                if is_last:
-                    held = sent
-                else:
-                    _submit(sent)
-                    is_first = False
+                    if is_last:
+                        held = sent
+                    else:
+                        _submit(sent)
+                        is_first = False
 
-    except Exception as e:
-        for fut, _ in audio_queue:
-            fut.cancel()
-        yield f"data: {json.dumps({'chunk': '', 'done': True, 'error': str(e)})}\n\n"
-        return
-
-    if tts_enabled:
-        remaining = buffer.strip()
-
-        if held:
-            if remaining and len(remaining.split()) <= _MERGE_IF_WORDS:
-                _submit((held + " " + remaining).strip())
-            else:
-                _submit(held)
-                if remaining:
-                    _submit(remaining)
-        elif remaining:
-            _submit(remaining)
-
-        for fut, sent in audio_queue:
-            try:
-                audio = fut.result(timeout=15)
-                b64 = base64.b64encode(audio).decode("ascii")
-                yield f"data: {json.dumps({'audio': b64, 'sentence': sent})}\n\n"
-            except Exception as exc:
-                logger.warning("[TTS-INLINE] Failed for '%s': %s", sent[:40], exc)
-
-    yield f"data: {json.dumps({'chunk': '', 'done': True, 'session_id': session_id})}\n\n"
+        except Exception as e:
+            yield _event_frame({"chunk": "", "done": True, "error": str(e)})
+            return
+
+        if tts_enabled:
+            remaining = buffer.strip()
+
+            if held:
+                if remaining and len(remaining.split()) <= _MERGE_IF_WORDS:
+                    _submit((held + " " + remaining).strip())
+                else:
+                    _submit(held)
+                    if remaining:
+                        _submit(remaining)
+            elif remaining:
+                _submit(remaining)
+            _flush_tts()
+
+            for task, sent in audio_queue:
+                try:
+                    audio = await asyncio.wait_for(task, timeout=15)
+                    yield _audio_frame(audio, sent)
+                except Exception as exc:
+                    logger.warning("[TTS-INLINE] Failed for '%s': %s", sent[:40], exc)
+            audio_queue.clear()
+
+        yield _event_frame({"chunk": "", "done": True, "session_id": session_id})
+    finally:
+        if audio_wait is not None:
+            audio_wait.cancel()
+        for task, _ in audio_queue:
+            task.cancel()
+        next_chunk.cancel()
+        # Let the cancelled __anext__ settle first: aclose() on a running generator raises.
+        await asyncio.wait({next_chunk})
+        await chunks.aclose()
 
 
 @app.post("/chat/stream")
@@ -413,7 +579,7 @@ async def chat_stream(request: ChatRequest):
         raise HTTPException(status_code=503, detail=str(e))
 
     except Exception as e:
-        if _is_rate_limit_error(e):
+        if is_rate_limit_error(e):
             raise HTTPException(status_code=429, detail=RATE_LIMIT_MESSAGE)
         logger.error("[API /chat/stream] Error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -432,7 +598,6 @@ async def chat_realtime(request: ChatRequest):  # ← fixed type hint (was ChatR
     try:
         session_id = chat_service.get_or_create_session(request.session_id)
         response_text = chat_service.process_realtime_message(session_id, request.message)
-        chat_service.save_chat_session(session_id)
         logger.info("[API /chat/realtime] Done | session_id=%s | response_len=%d", session_id[:12], len(response_text))
         return ChatResponse(response=response_text, session_id=session_id)
 
@@ -445,7 +610,7 @@ async def chat_realtime(request: ChatRequest):  # ← fixed type hint (was ChatR
         raise HTTPException(status_code=503, detail=str(e))
 
     except Exception as e:
-        if _is_rate_limit_error(e):
+        if is_rate_limit_error(e):
             logger.warning("[API /chat/realtime] Rate limit hit: %s", e)
             raise HTTPException(status_code=429, detail=RATE_LIMIT_MESSAGE)
         logger.error("[API /chat/realtime] Error: %s", e, exc_info=True)
@@ -476,7 +641,7 @@ async def chat_realtime_stream(request: ChatRequest):
         raise HTTPException(status_code=503, detail=str(e))
 
     except Exception as e:
-        if _is_rate_limit_error(e):
+        if is_rate_limit_error(e):
             raise HTTPException(status_code=429, detail=RATE_LIMIT_MESSAGE)
         logger.error("[API /chat/realtime/stream] Error: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -506,10 +671,8 @@ async def text_to_speech(request: TTSRequest):
 
     async def generate():
         try:
-            communicate = edge_tts.Communicate(text=text, voice=TTS_VOICE, rate=TTS_RATE)
-            async for chunk in communicate.stream():
-                if chunk["type"] == "audio":
-                    yield chunk["data"]
+            async for audio in _get_tts_session().stream(text):
+                yield audio
         except Exception as e:
             logger.error("[TTS] Error generating speech: %s", e)
             yield b""
@@ -521,26 +684,27 @@ async def text_to_speech(request: TTSRequest):
     )
 
 
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that marks the frontend no-cache.
+
+    File names are not content-hashed, so browsers must revalidate every file; unchanged ones
+    come back as a bodyless 304 via the built-in ETag/Last-Modified handling. Done per file
+    response rather than in a middleware, so API and SSE responses are not wrapped.
+    """
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = "no-cache"
+        return response
+
+
 _frontend_dir = Path(__file__).resolve().parent.parent / "frontend"
 
 if _frontend_dir.exists():
-    app.mount("/app", StaticFiles(directory=str(_frontend_dir), html=True), name="frontend")
+    app.mount("/app", CachedStaticFiles(directory=str(_frontend_dir), html=True), name="frontend")
 
 
 @app.get("/")
 async def root_redirect():
     return RedirectResponse(url="/app/", status_code=302)
-
-
-def run():
-    uvicorn.run(
-        "app.main:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
-
-
-if __name__ == "__main__":
-    run()
\ No newline at end of file
@@ -1,11 +1,16 @@
-import json
 import logging
+import os
+import threading
 import time
-from typing import Dict, List, Optional, Iterator 
+import re
+from typing import Deque, Dict, List, Optional, Iterator, Set, Tuple
+from collections import deque
 from pathlib import Path
-import uuid
+import secrets
+import orjson
+import aiofiles
 
-from config import CHATS_DATA_DIR, MAX_CHAT_HISTORY_TURNS
+from config import CHATS_DATA_DIR, MAX_CHAT_HISTORY_TURNS, PRETTY_SAVE
 from app.models import ChatMessage,ChatHistory
 from app.services.groq_service import GroqService
 from app.services.realtime_service import RealtimeGroqService
@@ -13,6 +18,10 @@ from app.services.realtime_service import RealtimeGroqService
 logger = logging.getLogger("J.A.R.V.I.S")
 
 SAVE_EVERY_N_CHUNKS = 5
+AUTOSAVE_INTERVAL_SECONDS = 2.0
+# Letters, digits, "_" and "-" only: rules out path traversal and separators by construction.
+_SESSION_RE = re.compile(r"\A[A-Za-z0-9_\-]{1,255}\Z")
+_SAVE_OPTIONS = orjson.OPT_INDENT_2 if PRETTY_SAVE else 0
 
 class ChatService:
 
@@ -20,19 +29,57 @@ class ChatService:
         self.groq_service = groq_service
         self.realtime_service = realtime_service
         self.sessions: Dict[str, List[ChatMessage]] = {}
+        self._paths: Dict[str, Path] = {}
+        # Streams add to this from worker threads while the autosave task swaps it out.
+        self._dirty: Set[str] = set()
+        self._dirty_lock = threading.Lock()
+        # Every snapshot gets a sequence number; a file is only swapped in if nothing newer
+        # for that session has been written since, so a slow autosave can't overwrite a
+        # later save (and misplace the .jsonl delta replay).
+        self._save_lock = threading.Lock()
+        self._save_seq = 0
+        self._written_seq: Dict[str, int] = {}
+        self._stream_bufs: Dict[str, List[str]] = {}
+        self.history_pairs: Dict[str, Deque[Tuple[ChatMessage, ChatMessage]]] = {}
 
-    def load_session_from_disk(self,session_id: str) -> bool:
-        safe_session_id = session_id.replace("-","").replace(" ","_")
-        filename = f"chat_{safe_session_id}.json"
-        filepath = CHATS_DATA_DIR / filename
+    def _session_path(self, session_id: str) -> Path:
+        filepath = self._paths.get(session_id)
+        if filepath is None:
+            safe_session_id = session_id.replace("-","").replace(" ","_")
+            filepath = CHATS_DATA_DIR / f"chat_{safe_session_id}.json"
+            self._paths[session_id] = filepath
+        return filepath
+
+    def _delta_path(self, session_id: str) -> Path:
+        return self._session_path(session_id).with_suffix(".jsonl")
+
+    def _snapshot(self, session_id: str) -> Tuple[int, bytes]:
+        with self._save_lock:
+            self._save_seq += 1
+            return self._save_seq, orjson.dumps(self._session_dict(session_id), option=_SAVE_OPTIONS)
+
+    def _commit_snapshot(self, session_id: str, seq: int, tmp_path: Path, filepath: Path):
+        with self._save_lock:
+            if seq < self._written_seq.get(session_id, 0):
+                tmp_path.unlink(missing_ok=True)
+                return
+            os.replace(tmp_path, filepath)
+            self._written_seq[session_id] = seq
 
+    @staticmethod
+    def _temp_path(filepath: Path) -> Path:
+        # Unique per write, so the request-thread and autosave writers never share a temp file;
+        # each then swaps its own complete file in with os.replace.
+        return filepath.with_name(f"{filepath.name}.{secrets.token_hex(4)}.tmp")
+
+    def load_session_from_disk(self,session_id: str) -> bool:
+        filepath = self._session_path(session_id)
 
         if not filepath.exists():
             return False
         
         try:
-            with open(filepath, "r",encoding="utf-8") as f:
-                chat_dict = json.load(f)
+            chat_dict = orjson.loads(filepath.read_bytes())
             
             messages = [
                 ChatMessage(role=msg.get("role"),content=msg.get("content"))
@@ -40,6 +87,18 @@ class ChatService:
             ]
 
             self.sessions[session_id] = messages
+            self._rebuild_history_pairs(session_id)
+
+            # A leftover delta log means a stream was interrupted: replay it onto the
+            # partial assistant message, then fold it back into the canonical JSON.
+            delta_path = self._delta_path(session_id)
+            if delta_path.exists():
+                if messages and messages[-1].role == "assistant":
+                    with open(delta_path, "rb") as f:
+                        deltas = [orjson.loads(line)["delta"] for line in f if line.strip()]
+                    messages[-1].content += "".join(deltas)
+                self.save_chat_session(session_id, log_timing=False)
+                delta_path.unlink(missing_ok=True)
             return True
         
         except Exception as e:
@@ -47,30 +106,21 @@ class ChatService:
             return False
         
     def validate_session_id(self,session_id:str) -> bool:
-        if not session_id or not session_id.strip():
-            return False
-        
-        if ".." in session_id or "/" in session_id or "\\" in session_id:
-            return False
-        
-        if len(session_id) > 255:
-            return False
-        
-        return True
+        return bool(session_id) and _SESSION_RE.match(session_id) is not None
     
     def get_or_create_session(self,session_id: Optional[str] = None) -> str:
         t0 = time.perf_counter()
 
         if not session_id:
-            new_session_id = str(uuid.uuid4())
+            new_session_id = secrets.token_hex(16)
             self.sessions[new_session_id] = []
             logger.info("[TIMING] session_get_or_create: %.3fs (news)",time.perf_counter() - t0)
             return new_session_id
         
         if not self.validate_session_id(session_id):
             raise ValueError(
-                f"Invalid session_id format: {session_id}. Session ID must be non-empty,"
-                "not contain path traversal characters, and be under 255 character."
+                f"Invalid session_id format: {session_id}. Session ID must be 1-255 characters "
+                "of letters, digits, '_' or '-'."
             )
         
         if session_id in self.sessions:
@@ -90,31 +140,43 @@ class ChatService:
         if session_id not in self.sessions:
             self.sessions[session_id] = []
         
-        self.sessions[session_id].append(ChatMessage(role=role,content=content))
+        messages = self.sessions[session_id]
+        message = ChatMessage(role=role,content=content)
+        if role == "assistant" and messages and messages[-1].role == "user":
+            if session_id not in self.history_pairs:
+                self._rebuild_history_pairs(session_id)
+            self.history_pairs[session_id].append((messages[-1], message))
+        messages.append(message)
+        with self._dirty_lock:
+            self._dirty.add(session_id)
 
     def get_chat_history(self, session_id: str) -> List[ChatMessage]:
-        return self.sessions.get(session_id,[])
+        messages = self.sessions.get(session_id,[])
+        buf = self._stream_bufs.get(session_id)
+        if buf and messages:
+            # A reply is still streaming; show its text so far without touching the stored message.
+            messages = messages[:-1] + [ChatMessage(role=messages[-1].role, content="".join(buf))]
+        return messages
     
 
+    def _rebuild_history_pairs(self, session_id: str):
+        pairs = deque(maxlen=MAX_CHAT_HISTORY_TURNS + 1)
+        messages = self.sessions.get(session_id, [])
+        for prev, msg in zip(messages, messages[1:]):
+            if prev.role == "user" and msg.role == "assistant":
+                pairs.append((prev, msg))
+        self.history_pairs[session_id] = pairs
+
     def format_history_for_llm(self, session_id: str, exclude_last: bool = False) -> List[tuple]:
-        
-        
-        messages = self.get_chat_history(session_id)
-        history = []
-
-        messages_to_process = messages[:-1] if exclude_last and messages else messages
-        i = 0
-        while i < len(messages_to_process) - 1:
-            user_msg = messages_to_process[i]
-            ai_msg = messages_to_process[i+1]
-            if user_msg.role == "user" and ai_msg.role == "assistant":
-                history.append((user_msg.content, ai_msg.content))
-                i += 2
-            else:
-                i += 1
-        if len(history) > MAX_CHAT_HISTORY_TURNS:
-            history = history[-MAX_CHAT_HISTORY_TURNS:]
-        return history
+        # Pairs hold the ChatMessage objects. A reply that is still streaming keeps ""
+        # as its content until it finishes (the text lives in _stream_bufs), which is
+        # why the in-progress pair is dropped with exclude_last. One extra slot is kept
+        # so that dropping it still leaves a full window.
+        pairs = list(self.history_pairs.get(session_id, ()))
+        messages = self.sessions.get(session_id, [])
+        if exclude_last and pairs and messages and pairs[-1][1] is messages[-1]:
+            pairs.pop()
+        return [(user_msg.content, ai_msg.content) for user_msg, ai_msg in pairs[-MAX_CHAT_HISTORY_TURNS:]]
     
     def process_message(self, session_id: str, user_message: str) -> str:
         logger.info("[GENERAL] Session: %s | User: %.200s", session_id[:12], user_message)
@@ -148,21 +210,27 @@ class ChatService:
         chat_history = self.format_history_for_llm(session_id, exclude_last=True)
         logger.info("[GENERAL-STREAM] History pairs sent to LLM: %d", len(chat_history))
         chunk_count = 0
+        self.save_chat_session(session_id, log_timing=False)
+        buf = self._stream_bufs[session_id] = []
         try:
             for chunk in self.groq_service.stream_response(
                 question=user_message, chat_history=chat_history
             ):
                 
-                self.sessions[session_id][-1].content += chunk
+                buf.append(chunk)
                 chunk_count += 1
                 if chunk_count % SAVE_EVERY_N_CHUNKS == 0:
-                    self.save_chat_session(session_id,log_timing=False)
+                    self.save_chat_delta(session_id, "".join(buf[-SAVE_EVERY_N_CHUNKS:]))
 
                 yield chunk
         finally:
             
-            final_response = self.sessions[session_id][-1].content
+            self._stream_bufs.pop(session_id, None)
+            final_response = "".join(buf)
+            self.sessions[session_id][-1].content = final_response
             logger.info("[GENERAL-STREAM] Completed | Chunks: %d | Response length: %d chars", chunk_count, len(final_response))
+            self.save_chat_session(session_id)
+            self._delta_path(session_id).unlink(missing_ok=True)
 
     def process_realtime_message_stream(
             self, session_id: str, user_message: str
@@ -177,6 +245,8 @@ class ChatService:
         chat_history = self.format_history_for_llm(session_id, exclude_last=True)
         logger.info("[REALTIME-STREAM] History pairs sent to LLM: %d", len(chat_history))
         chunk_count = 0
+        self.save_chat_session(session_id, log_timing=False)
+        buf = self._stream_bufs[session_id] = []
         try:
             for chunk in self.realtime_service.stream_response(
                 question=user_message, chat_history=chat_history
@@ -184,34 +254,69 @@ class ChatService:
                 if isinstance(chunk, dict):
                     yield chunk
                     continue
-                self.sessions[session_id][-1].content += chunk
-                if chunk_count %SAVE_EVERY_N_CHUNKS == 0:
-                    self.save_chat_session(session_id,log_timing=False)
+                buf.append(chunk)
+                chunk_count += 1
+                if chunk_count % SAVE_EVERY_N_CHUNKS == 0:
+                    self.save_chat_delta(session_id, "".join(buf[-SAVE_EVERY_N_CHUNKS:]))
                 yield chunk
         finally:
-            final_response = self.sessions[session_id][-1].content
+            self._stream_bufs.pop(session_id, None)
+            final_response = "".join(buf)
+            self.sessions[session_id][-1].content = final_response
             logger.info("[REALTIME-STREAM] Completed | Chunks: %d | Response length: %d chars", chunk_count, len(final_response))
             self.save_chat_session(session_id)
+            self._delta_path(session_id).unlink(missing_ok=True)
 
 
+    def save_chat_delta(self, session_id: str, delta: str):
+        try:
+            with open(self._delta_path(session_id), "ab") as f:
+                f.write(orjson.dumps({"delta": delta}) + b"\n")
+        except Exception as e:
+            logger.error("Failed to append chat delta for session %s: %s", session_id, e)
+
+    def _session_dict(self, session_id: str) -> dict:
+        messages = [{"role":msg.role, "content":msg.content} for msg in self.sessions[session_id]]
+        buf = self._stream_bufs.get(session_id)
+        if buf:
+            # A reply is still streaming; its text lives in the chunk buffer until it finishes.
+            messages[-1]["content"] = "".join(buf)
+        return {"session_id":session_id, "messages":messages}
+
     def save_chat_session(self,session_id: str, log_timing: bool = True):
         if session_id not in self.sessions or not self.sessions[session_id]:
             return
         
-        messages = self.sessions[session_id]
-        safe_session_id = session_id.replace("-","").replace(" ", "_")
-        filename = f"chat_{safe_session_id}.json"
-        filepath = CHATS_DATA_DIR / filename
-        chat_dict = {
-            "session_id":session_id,
-            "messages":[{"role":msg.role, "content":msg.content} for msg in messages]
-        }
+        with self._dirty_lock:
+            self._dirty.discard(session_id)
+        filepath = self._session_path(session_id)
+        tmp_path = self._temp_path(filepath)
 
         try:
             t0 = time.perf_counter() if log_timing else 0
-            with open(filepath, "w", encoding="utf-8") as f:
-                json.dump(chat_dict, f, indent=2, ensure_ascii=False)
+            seq, data = self._snapshot(session_id)
+            tmp_path.write_bytes(data)
+            self._commit_snapshot(session_id, seq, tmp_path, filepath)
             if log_timing:
                 logger.info("[TIMING] save_session_json: %.3fs", time.perf_counter() - t0)
         except Exception as e:
-            logger.error("Failed to save chat session %s to disk %s",session_id, e)
\ No newline at end of file
+            tmp_path.unlink(missing_ok=True)
+            logger.error("Failed to save chat session %s to disk %s",session_id, e)
+
+    async def flush_dirty_sessions(self):
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+        for session_id in dirty:
+            if not self.sessions.get(session_id):
+                continue
+            filepath = self._session_path(session_id)
+            tmp_path = self._temp_path(filepath)
+            try:
+                seq, data = self._snapshot(session_id)
+                async with aiofiles.open(tmp_path, "wb") as f:
+                    await f.write(data)
+                # A rename under the save lock: cheap enough to do on the loop thread.
+                self._commit_snapshot(session_id, seq, tmp_path, filepath)
+            except Exception as e:
+                tmp_path.unlink(missing_ok=True)
+                logger.error("Failed to save chat session %s to disk %s",session_id, e)
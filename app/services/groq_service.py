@@ -1,13 +1,24 @@
-from typing import List, Optional, Iterator
+from typing import Generator, List, Optional, Iterator
 from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from groq import RateLimitError as GroqRateLimitError
 
+import httpx
 import logging
+import re
+import threading
 import time
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
 
-from config import GROQ_API_KEYS, GROQ_MODEL, JARVIS_SYSTEM_PROMPT, GENERAL_CHAT_ADDENDUM
+from config import (
+    get_groq_api_keys, GROQ_MODEL, JARVIS_SYSTEM_PROMPT, GENERAL_CHAT_ADDENDUM,
+    GROQ_HEDGE_DELAY_SECONDS, MAX_CHAT_HISTORY_TURNS,
+    SEMANTIC_CACHE_ENABLED, SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL_SECONDS,
+)
 from app.services.vector_store import VectorStoreService
+from app.services.response_cache import SemanticResponseCache
 from app.utils.time_info import get_time_information
 from app.utils.retry import with_retry
 
@@ -15,6 +26,16 @@ logger = logging.getLogger("J.A.R.V.I.S")
 
 
 GROQ_REQUEST_TIMEOUT = 60
+GROQ_MAX_CONCURRENT_PER_KEY = 4
+RETRIEVAL_TIMEOUT_SECONDS = 5
+
+# One keep-alive HTTP/2 pool for every key: auth is a per-request header, so all
+# ChatGroq clients can share connections and skip repeated TLS handshakes.
+_HTTP_CLIENT = httpx.Client(
+    http2=True,
+    timeout=GROQ_REQUEST_TIMEOUT,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+)
 
 ALL_APIS_FAILED_MESSAGE = (
     "I'm unable to process your request at the movement. All API services are"
@@ -24,15 +45,15 @@ ALL_APIS_FAILED_MESSAGE = (
 class AllGroqApisFailedError(Exception):
     pass
 
-def escape_curly_braces(text: str) -> str:
-    if not text:
-        return text
-    return text.replace("{","{{").replace("}","}}")
-
+_RATE_LIMIT_RE = re.compile(r"429|rate limit|tokens per day", re.IGNORECASE)
 
-def _is_rate_limit_error(exc: BaseException) -> bool:
-    msg = str(exc).lower()
-    return "429" in str(exc) or "rate limit" in msg or "tokens per day" in msg
+def is_rate_limit_error(exc: BaseException) -> bool:
+    """True if the exception (or the one it was raised from) is a Groq rate limit (429 / tokens per day)."""
+    for err in (exc, exc.__cause__):
+        if isinstance(err, GroqRateLimitError) or getattr(err, "status_code", None) == 429:
+            return True
+    # Fallback for wrappers that only carry the provider's message.
+    return _RATE_LIMIT_RE.search(str(exc)) is not None
 
 def _log_timing(label: str, elapsed: float, extra: str = ""):
     msg = f"[TIMING] {label}: {elapsed:.3f}s"
@@ -46,13 +67,32 @@ def _mask_api_key(key: str) -> str:
     return f"{key[:8]}...{key[-4:]}"
 
 
+@lru_cache(maxsize=8)
+def build_prompt_template(mode_addendum: str = "") -> ChatPromptTemplate:
+    """Prompt template for one chat mode, built once per mode addendum.
+
+    The persona prompt and the mode addendum are constant message objects (never run
+    through template formatting), so every request in a mode starts with the exact same
+    bytes, which is what provider-side prefix caching keys on. Per-request data (time,
+    retrieved context, search results) is one system message substituted as a template
+    variable between them, so nothing needs brace escaping.
+    """
+    messages = [SystemMessage(content=JARVIS_SYSTEM_PROMPT), ("system", "{system_message}")]
+    if mode_addendum:
+        messages.append(SystemMessage(content=mode_addendum))
+    messages.append(MessagesPlaceholder(variable_name="history"))
+    messages.append(("human", "{question}"))
+    return ChatPromptTemplate.from_messages(messages)
+
+
 class GroqService:
 
 
 
     def __init__(self,vector_store_service:VectorStoreService):
 
-        if not GROQ_API_KEYS:
+        self.api_keys = get_groq_api_keys()
+        if not self.api_keys:
             raise ValueError(
                 "NO Groq API keys configured. Set GROQ_API_KEY (and optionally GROQ_API_KEY_3, ...) in .env"
             )
@@ -62,12 +102,25 @@ class GroqService:
                 groq_api_key=key,
                 model_name=GROQ_MODEL,
                 temperature=0.8,
-                request_timeout=GROQ_REQUEST_TIMEOUT
+                request_timeout=GROQ_REQUEST_TIMEOUT,
+                http_client=_HTTP_CLIENT,
             ) 
-            for key in GROQ_API_KEYS
+            for key in self.api_keys
         ]
         self.vector_store_service = vector_store_service
-        logger.info(f"Initialized GroqService with {len(GROQ_API_KEYS)} API key(s) API key(s) (primary-first fallback)")
+        self._key_semaphores = [threading.BoundedSemaphore(GROQ_MAX_CONCURRENT_PER_KEY) for _ in self.llms]
+        self._llm_pool = ThreadPoolExecutor(max_workers=len(self.llms) * GROQ_MAX_CONCURRENT_PER_KEY)
+        self._retrieval_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="retrieval")
+        self._response_cache = (
+            SemanticResponseCache(
+                vector_store_service.emeddings,
+                threshold=SEMANTIC_CACHE_THRESHOLD,
+                ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS,
+            )
+            if SEMANTIC_CACHE_ENABLED else None
+        )
+
+        logger.info(f"Initialized GroqService with {len(self.api_keys)} API key(s) (primary-first fallback)")
     
     def _invoke_llm(
             self,
@@ -79,44 +132,61 @@ class GroqService:
         n = len(self.llms)
         last_exc = None
         keys_tried = []
+        pending = {}
 
-        for i in range(n):
-            keys_tried.append(i)
-            masked_key = _mask_api_key(GROQ_API_KEYS[i])
-            logger.info(f"Trying API key #{i + 1}/{n}: {masked_key}")
-
-            def _invoke_with_key():
-
-                chain = prompt | self.llm[i]
-
-                return chain.invoke({"history": messages, "question": question})
-            
-            try:
-
-                response = with_retry(
-                    _invoke_with_key,
+        def _invoke_with_key(i: int):
+            # Cap in-flight requests per key so hedging never exceeds provider concurrency.
+            with self._key_semaphores[i]:
+                chain = prompt | self.llms[i]
+                return with_retry(
+                    lambda: chain.invoke({"history": messages, "question": question}),
                     max_retries=2,
                     initial_delay=0.5
                 )
 
+        def _submit_next():
+            i = len(keys_tried)
+            keys_tried.append(i)
+            logger.info(f"Trying API key #{i + 1}/{n}: {_mask_api_key(self.api_keys[i])}")
+            pending[self._llm_pool.submit(_invoke_with_key, i)] = i
+
+        # Hedged requests: start the primary key, and if it has not answered within
+        # GROQ_HEDGE_DELAY_SECONDS (or fails), start the next key too. First success wins.
+        _submit_next()
+        while pending:
+            timeout = GROQ_HEDGE_DELAY_SECONDS if len(keys_tried) < n else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+                logger.info("API key response slow, hedging with next key...")
+                _submit_next()
+                continue
+
+            for fut in done:
+                i = pending.pop(fut)
+                masked_key = _mask_api_key(self.api_keys[i])
+                try:
+                    response = fut.result()
+                except Exception as e:
+                    last_exc = e
+                    if is_rate_limit_error(e):
+                        logger.warning(f"API key #{i + 1}/{n} rate limited: {masked_key}")
+                    else:
+                        logger.warning(f"API key #{i + 1} failed: {masked_key} - {str(e)[:100]}")
+                    continue
+
+                # The Groq client cannot abort an in-flight call; late responses are dropped.
+                for other in pending:
+                    other.cancel()
                 if i > 0:
                     logger.info(f"fallback successful: API key #{i + 1}/{n} succeeded: {masked_key}")
-                
                 return response.content
-            
-            except Exception as e:
-                last_exc = e
-                if _is_rate_limit_error(e):
-                    logger.warning(f"API key #{i + 1}/{n} rate limited: {masked_key}")
-                else:
-                    logger.warning(f"API key #{i + 1} failed: {masked_key} - {str(e)[:100]}")
 
-                if i < n -1:
-                    logger.info(f"Failling back to next API key...")
-                    continue
-                break
+            if not pending and len(keys_tried) < n:
+                logger.info(f"Failling back to next API key...")
+                _submit_next()
         
-        masked_all = ", ".join([_mask_api_key(GROQ_API_KEYS[j]) for j in keys_tried])
+        masked_all = ", ".join([_mask_api_key(self.api_keys[j]) for j in keys_tried])
         logger.error(f"All {n} API key(s) failed. Tried: {masked_all}")
 
         raise AllGroqApisFailedError(ALL_APIS_FAILED_MESSAGE) from last_exc
@@ -126,37 +196,43 @@ class GroqService:
             prompt: ChatPromptTemplate,
             messages: list,
             question: str,
-    ) -> Iterator[str]:
-        
-
+            collect: Optional[list] = None,
+    ) -> Generator[str, None, bool]:
+        """Stream the answer, falling back across keys.
+
+        Yielded chunks are also appended to collect when given. Returns True if the
+        streamed text came from one key only; False if a key failed mid-answer and the
+        next one restarted it, so the concatenated text holds a partial answer first.
+        """
         n = len(self.llms)
         last_exc = None
+        restarted = False
 
         for i in range(n):
-            masked_key = _mask_api_key(GROQ_API_KEYS[i])
+            masked_key = _mask_api_key(self.api_keys[i])
             logger.info(f"Streaming with API key #{i + 1}/{n}: {masked_key}")
 
             try:
 
-                chain = prompt | self.llms[i]
                 chunk_count = 0
+                chain = prompt | self.llms[i]
                 first_chunk_time = None
                 stream_start = time.perf_counter()
 
                 for chunk in chain.stream({"history":messages, "question": question}):
 
-                    content = ""
-                    if hasattr(chunk, "content"):
-                        content = chunk.content or ""
+                    # Chunks are AIMessageChunk in practice; the dict branch is only a fallback.
+                    content = getattr(chunk, "content", None)
+                    if content is None and isinstance(chunk, dict):
+                        content = chunk.get("content")
 
-                    elif isinstance(chunk, dict) and "content" in chunk:
-                        content = chunk.get("content", "") or ""
-                    
-                    if isinstance(content, str) and content:
+                    if content and isinstance(content, str):
                         if first_chunk_time is None:
                             first_chunk_time = time.perf_counter() - stream_start
                             _log_timing("first_chunk", first_chunk_time)
                         chunk_count += 1
+                        if collect is not None:
+                            collect.append(content)
 
                         yield content
                 
@@ -165,13 +241,14 @@ class GroqService:
 
                 if i > 0 and chunk_count > 0:
                     logger.info(f"Fallback successful: API key #{i + 1}/{n} streamed: {masked_key}")
-                return
+                return not restarted
             except Exception as e:
                 last_exc = e
-                if _is_rate_limit_error(e):
+                restarted = restarted or chunk_count > 0
+                if is_rate_limit_error(e):
                     logger.warning(f"API key #{i+1}/{n} rate limited: {masked_key}")
                 else:
-                    logger.warning(f"API key #{i+1}/{n} rate limited: {masked_key} - {str(e)[:100]}")
+                    logger.warning(f"API key #{i+1}/{n} failed: {masked_key} - {str(e)[:100]}")
 
                 if i < n - 1:
 
@@ -182,73 +259,91 @@ class GroqService:
         logger.error(f"All {n} API key(s) failed during stream...")
         raise AllGroqApisFailedError(ALL_APIS_FAILED_MESSAGE) from last_exc
     
+    def _retrieve_context_docs(self, question: str) -> list:
+        t0 = time.perf_counter()
+        try:
+            retriever = self.vector_store_service.get_retriever(k = 10)
+            return retriever.invoke(question)
+        except Exception as retrieval_err:
+            logger.info("Vector store retrieval failed, using empty context: %s", retrieval_err)
+            return []
+        finally:
+            _log_timing("vector_db", time.perf_counter() - t0)
+
     def _build_prompt_and_messages(
             self,
             question: str,
             chat_history: Optional[List[tuple]] = None,
             extra_system_parts: Optional[List[str]] = None,
             mode_addendum: str = "",
+            context_docs: Optional[list] = None,
     ) -> tuple :
         
-        context = ""
-        context_sources = []
-        t0 = time.perf_counter()
-
-        try:
-
-            retriever = self.vector_store_service.get_retriever(k = 10)
-
-            context_docs = retriever.invoke(question)
+        # Query embedding + FAISS search run on a worker while the rest of the prompt
+        # (time block, history messages) is assembled here.
+        docs_future = None
+        if context_docs is None:
+            docs_future = self._retrieval_pool.submit(self._retrieve_context_docs, question)
+
+        parts = ["Current time and date: ", get_time_information()]
+
+        # ChatService already trims history; enforce the same cap here for any other caller.
+        recent = chat_history[-MAX_CHAT_HISTORY_TURNS:] if chat_history else ()
+        messages = [None] * (2 * len(recent))
+        for j, (human_msg, ai_msg) in enumerate(recent):
+            messages[2 * j] = HumanMessage(content=human_msg)
+            messages[2 * j + 1] = AIMessage(content=ai_msg)
+
+        if docs_future is not None:
+            try:
+                context_docs = docs_future.result(timeout=RETRIEVAL_TIMEOUT_SECONDS)
+            except FutureTimeoutError:
+                logger.warning("[CONTEXT] Retrieval took longer than %ss, continuing without context", RETRIEVAL_TIMEOUT_SECONDS)
+                context_docs = []
 
-            if context_docs:
+        if context_docs:
 
-                context = "\n".join([doc.page_content for doc in context_docs])
-                context_sources = [doc.metadata.get("source","unknown") for doc in context_docs]
-                logger.info("[CONTEXT] Retrieved %d chunks from sources: %s",len(context_docs), context_sources)
-            
-            else:
-                logger.info("[CONTEXT] No relevant chunks found for query")
+            parts.append("\n\nRelavent context from your learning data and past conversations:\n")
+            parts.append("\n".join([doc.page_content for doc in context_docs]))
+            context_sources = [doc.metadata.get("source","unknown") for doc in context_docs]
+            logger.info("[CONTEXT] Retrieved %d chunks from sources: %s",len(context_docs), context_sources)
         
-        except Exception as retrieval_err:
-            logger.info("Vector store retrieval failed, using empty context: %s", retrieval_err)
-        
-        finally:
-            _log_timing("vector_db", time.perf_counter() - t0)
-        
-        time_info = get_time_information()
-        system_message = JARVIS_SYSTEM_PROMPT
-
-        system_message += f"\n\nCurrent time and date: {time_info}"
+        else:
+            logger.info("[CONTEXT] No relevant chunks found for query")
 
-        if context:
+        for extra in extra_system_parts or ():
+            parts.append("\n\n")
+            parts.append(extra)
 
-            system_message += f"\n\nRelavent context from your learning data and past conversations:\n{escape_curly_braces(context)}"
+        system_message = "".join(parts)
 
-        if extra_system_parts:
-
-            system_message += f"\n\n" + "\n\n".join(extra_system_parts)
-        
-        if mode_addendum:
-            system_message += f"\n\n{mode_addendum}"
-
-        prompt = ChatPromptTemplate.from_messages([
-                ("system", system_message),
-                MessagesPlaceholder(variable_name="history"),
-                ("human","{question}")
-            ])
-
-        messages = []
-        if chat_history:
-            for human_msg, ai_msg in chat_history:
-                messages.append(HumanMessage(content=human_msg))
-                messages.append(AIMessage(content=ai_msg))
+        prompt = build_prompt_template(mode_addendum).partial(system_message=system_message)
             
-        logger.info("[PROMPT] System message length: %d chars | History pairs: %d | Question: %.100s",
-                        len(system_message), len(chat_history)) if chat_history else 0, question
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("[PROMPT] System message length: %d chars | History pairs: %d | Question: %.100s",
+                        len(JARVIS_SYSTEM_PROMPT) + len(system_message) + len(mode_addendum), len(recent), question)
             
         return prompt, messages
         
 
+    def _cache_lookup(self, question: str, chat_history: Optional[List[tuple]]) -> Optional[str]:
+        # Only opening questions are cached: a follow-up's meaning depends on the history.
+        if self._response_cache is None or chat_history:
+            return None
+        try:
+            return self._response_cache.lookup(question)
+        except Exception as e:
+            logger.warning("[CACHE] Semantic cache lookup failed: %s", e)
+            return None
+
+    def _cache_store(self, question: str, chat_history: Optional[List[tuple]], response: str):
+        if self._response_cache is None or chat_history:
+            return
+        try:
+            self._response_cache.store(question, response)
+        except Exception as e:
+            logger.warning("[CACHE] Semantic cache store failed: %s", e)
+
     def get_response(
             self,
             question: str,
@@ -256,6 +351,10 @@ class GroqService:
         ) -> str:
 
         try:
+            cached = self._cache_lookup(question, chat_history)
+            if cached is not None:
+                return cached
+
             prompt, messages = self._build_prompt_and_messages(
                 question,chat_history,mode_addendum=GENERAL_CHAT_ADDENDUM,
             )
@@ -264,6 +363,7 @@ class GroqService:
             result = self._invoke_llm(prompt,messages,question)
             _log_timing("groq_api", time.perf_counter()-t0)
             logger.info("[RESPONSE] General chat | Length: %d chars | Preview: %.120s", len(result), result)
+            self._cache_store(question, chat_history, result)
             return result
         except AllGroqApisFailedError:
             raise
@@ -277,15 +377,21 @@ class GroqService:
     ) -> Iterator[str]:
         
         try:
+            cached = self._cache_lookup(question, chat_history)
+            if cached is not None:
+                yield cached
+                return
+
             prompt, messages = self._build_prompt_and_messages(
                 question,chat_history,mode_addendum=GENERAL_CHAT_ADDENDUM
             )
-            yield from self._stream_llm(prompt, messages, question)
+            parts = []
+            # Only reached when the stream ran to the end: a client disconnect closes this
+            # generator (GeneratorExit) at the yield, so a cut-off answer is never cached.
+            single_key = yield from self._stream_llm(prompt, messages, question, collect=parts)
+            if single_key:
+                self._cache_store(question, chat_history, "".join(parts))
         except AllGroqApisFailedError:
             raise
         except Exception as e:
             raise Exception(f"Error streaming response from Groq: {str(e)}") from e
-
- 
-        
-        
@@ -1,18 +1,32 @@
 from typing import List, Optional,Iterator, Tuple, Any
-from tavily import TavilyClient
 import logging
-import os
+import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-from app.services.groq_service import GroqService, escape_curly_braces, AllGroqApisFailedError
+import httpx
+import orjson
+
+from app.services.groq_service import GroqService, AllGroqApisFailedError
 from app.services.vector_store import VectorStoreService
 from app.utils.retry import with_retry
-from config import REALTIME_CHAT_ADDENDUM, GROQ_API_KEYS, GROQ_MODEL
+from config import CONFIG, REALTIME_CHAT_ADDENDUM
 
 
 logger = logging.getLogger("J.A.R.V.I.S")
 
 GROQ_REQUEST_TIMEOUT_FAST = 15
+# Without history there are no references to resolve, so a slow rewrite is not
+# worth waiting for: search on the raw question instead.
+QUERY_REWRITE_WAIT_SECONDS = 0.5
+
+TAVILY_API_URL = "https://api.tavily.com"
+TAVILY_REQUEST_TIMEOUT = 10
+TAVILY_CACHE_TTL_SECONDS = 300
+TAVILY_CACHE_MAX_ENTRIES = 256
+_WHITESPACE_RE = re.compile(r"\s+")
 
 _QUERY_EXTRACTION_PROMPT = (
     "You are a search query optimizer. Given the user's message and recent conversation"
@@ -21,30 +35,48 @@ _QUERY_EXTRACTION_PROMPT = (
     "using the conversation history. Output ONLY the search query, nothing else"
 )
 
+# One keep-alive HTTP/2 pool for every Tavily search, so only the first call pays for TLS.
+_TAVILY_HTTP_CLIENT = httpx.Client(
+    base_url=TAVILY_API_URL,
+    http2=True,
+    timeout=TAVILY_REQUEST_TIMEOUT,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+
+
+class TavilySearchClient:
+    """Minimal Tavily /search client on the shared connection pool."""
+
+    def __init__(self, api_key: str):
+        self._headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
+
+    def search(self, **params) -> dict:
+        response = _TAVILY_HTTP_CLIENT.post("/search", content=orjson.dumps(params), headers=self._headers)
+        response.raise_for_status()
+        return orjson.loads(response.content)
+
 
 class RealtimeGroqService(GroqService):
     def __init__(self,vector_store_service: VectorStoreService):
         super().__init__(vector_store_service)
-        travily_api_key = os.getenv("TAVILY_API_KEY", "")
+        travily_api_key = CONFIG.tavily_api_key
         if travily_api_key:
-            self.tavily_client = TavilyClient(api_key=travily_api_key)
+            self.tavily_client = TavilySearchClient(travily_api_key)
             logger.info("Tavily search client initialized successfully")
         else:
             self.tavily_client = None
             logger.warning("TAVILY_API_KEY not set. Realtime search will be unavilable.")
 
-        if  GROQ_API_KEYS:
-            from langchain_groq import ChatGroq
-            self._fast_llm = ChatGroq(
-                qroq_api_key = GROQ_API_KEYS[0],
-                model_name = GROQ_MODEL,
-                temperature=0.0,
-                request_timeout = GROQ_REQUEST_TIMEOUT_FAST,
-                max_tokens=50,
-            )
-        else:
-            self._fast_llm = None
-        
+        # Reuse the primary key's client (and its connection pool) for the short rewrite call.
+        self._fast_llm = self.llms[0].bind(
+            max_tokens=50,
+            temperature=0.0,
+            timeout=GROQ_REQUEST_TIMEOUT_FAST,
+        )
+        self._prep_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="realtime-prep")
+        self._tavily_cache: "OrderedDict[str, Tuple[Tuple[str, Optional[dict]], float]]" = OrderedDict()
+        self._tavily_cache_lock = threading.Lock()
+
     def _extract_search_query(
         self, question: str, chat_history: Optional[List[tuple]] = None
         ) -> str:
@@ -101,6 +133,14 @@ class RealtimeGroqService(GroqService):
         if not self.tavily_client:
             logger.warning("Tavily client not initialized. TAVILY_API_KEY not set")
             return ("", None)
+
+        cache_key = f"{num_results}|{_WHITESPACE_RE.sub(' ', query.strip().lower())}"
+        with self._tavily_cache_lock:
+            hit = self._tavily_cache.get(cache_key)
+            if hit and time.monotonic() - hit[1] < TAVILY_CACHE_TTL_SECONDS:
+                self._tavily_cache.move_to_end(cache_key)
+                logger.info("[TAVILY] Cache hit for: %s", query)
+                return hit[0]
         
         try:
             t0 = time.perf_counter()
@@ -124,37 +164,37 @@ class RealtimeGroqService(GroqService):
                 logger.warning(f"NO Tavily search results found for query: {query}")
                 return ("",None)
             
+            parts = [f"=== WEB SEARCH RESULTS FOR: {query} ===\n"]
+            if ai_answer:
+                parts.append(f"AI-SYNTHESIZED ANSWER (use this as your primary source):\n{ai_answer}\n")
+            parts.append("INDIVIDUAL SOURCES:")
+
+            # One pass builds both the client payload and the prompt text.
+            payload_results = []
+            for i, result in enumerate(results[:num_results], 1):
+                title = result.get("title", "No title")
+                content = result.get("content") or ""
+                url = result.get("url", "")
+                score = float(result.get("score", 0))
+                payload_results.append({
+                    "title": title,
+                    "content": content[:500],
+                    "url": url,
+                    "score": round(score, 2),
+                })
+                parts.append(f"\n[Source {i}] (relevance: {score:.2f})")
+                parts.append(f"Title: {title}")
+                if content:
+                    parts.append(f"Content: {content}")
+                if url:
+                    parts.append(f"URL: {url}")
+
             payload: Optional[dict] = {
                 "query" : query,
                 "answer": ai_answer,
-                "results": [
-                    {
-                        "title": r.get("title", "No title"),
-                        "content": (r.get("content") or "")[:500],
-                        "url": r.get("url",""),
-                        "score": round(float(r.get("score", 0)),2),
-                    }
-                    for r in results[:num_results]
-                ]
+                "results": payload_results,
             }
 
-            parts = [f"=== WEB SEARCH RESULTS FOR: {query} ===\n"]
-            if ai_answer:
-                parts.append(f"AI-SYNTHESIZED ANSWER (use this as your primary source):\n{ai_answer}\n")
-            
-            if results:
-                parts.append("INDIVIDUAL SOURCES:")
-                for i,result in enumerate(results[:num_results],1):
-                    title = result.get('title', 'No title')
-                    content = result.get('content','')
-                    url = result.get('url','')
-                    score = result.get("score",0)
-                    parts.append(f"\n[Source {i}] (relevance: {score:.2f})")
-                    parts.append(f"Title: {title}")
-                    if content:
-                        parts.append(f"Content: {content}")
-                    if url:
-                        parts.append(f"URL: {url}")
             parts.append("\n=== END SEARCH RESULTS ===")
             formatted = "\n".join(parts)
 
@@ -164,6 +204,12 @@ class RealtimeGroqService(GroqService):
                 len(formatted), time.perf_counter() - t0,
             )
 
+            with self._tavily_cache_lock:
+                self._tavily_cache[cache_key] = ((formatted, payload), time.monotonic())
+                self._tavily_cache.move_to_end(cache_key)
+                while len(self._tavily_cache) > TAVILY_CACHE_MAX_ENTRIES:
+                    self._tavily_cache.popitem(last=False)
+
             return (formatted, payload)
         
         except Exception as e:
@@ -172,22 +218,39 @@ class RealtimeGroqService(GroqService):
             return ("", None)
     
 
+    def _prepare_realtime_context(
+        self, question: str, chat_history: Optional[List[tuple]] = None
+    ) -> Tuple[str, str, Optional[dict], list]:
+        # Vector retrieval does not depend on the search query, so it runs alongside
+        # the rewrite + Tavily round-trips instead of after them.
+        docs_future = self._prep_pool.submit(self._retrieve_context_docs, question)
+        query_future = self._prep_pool.submit(self._extract_search_query, question, chat_history)
+
+        try:
+            search_query = query_future.result(timeout=None if chat_history else QUERY_REWRITE_WAIT_SECONDS)
+        except FutureTimeoutError:
+            logger.info("[REALTIME] Query extraction still running after %.1fs, using raw question", QUERY_REWRITE_WAIT_SECONDS)
+            search_query = question
+        logger.info("[REALTIME] Searching Tavily for: %s", search_query)
+
+        formatted_results, payload = self.search_tavily(search_query, num_results=7)
+        if formatted_results:
+            logger.info("[REALTIME] Tavily returned results (length: %d chars)", len(formatted_results))
+        else:
+            logger.warning("[REALTIME] Tavily returned no results for: %s", search_query)
+
+        return search_query, formatted_results, payload, docs_future.result()
+
     def get_response(self, question: str, chat_history: Optional[List[tuple]] = None) -> str:
         try:
-            search_query = self._extract_search_query(question, chat_history)
-            logger.info("[REALTIME] Searching Tavily  for: %s",search_query)
+            _, formatted_results, _, context_docs = self._prepare_realtime_context(question, chat_history)
 
-            formatted_results, _ = self.search_tavily(search_query, num_results=7)
-            if formatted_results:
-                logger.info("[REALTIME] Tavily returned results (length: %d chars)", len(formatted_results))
-            else:
-                logger.warning("[REALTIME] Tavily returned no results for: %s",search_query)
-            
-            extra_parts = [escape_curly_braces(formatted_results)] if formatted_results else None
+            extra_parts = [formatted_results] if formatted_results else None
             prompt, messages = self._build_prompt_and_messages(
                 question,chat_history,
                 extra_system_parts=extra_parts,
                 mode_addendum=REALTIME_CHAT_ADDENDUM,
+                context_docs=context_docs,
             )
 
             t0 = time.perf_counter()
@@ -207,22 +270,18 @@ class RealtimeGroqService(GroqService):
 
     def stream_response(self, question: str, chat_history: Optional[List[tuple]] = None) -> Iterator[Any]:
         try:
-            search_query = self._extract_search_query(question, chat_history)
-            logger.info("[REALTIME] Searching on Tavily for: %s",search_query)
-
-            formatted_results, payload = self.search_tavily(search_query,num_results=7)
-            if formatted_results:
-                logger.info("[REALTIME] Tavily returned results (length: %d chars)", len(formatted_results))
-            else:
-                logger.warning("[REALTIME] Tavily returned no results for: %s", search_query)
+            search_query, formatted_results, payload, context_docs = self._prepare_realtime_context(
+                question, chat_history
+            )
             
             if payload:
                 yield {"_search_results":payload}
-            extra_parts = [escape_curly_braces(formatted_results)] if formatted_results else None
+            extra_parts = [formatted_results] if formatted_results else None
             prompt, messages = self._build_prompt_and_messages(
                 question,chat_history,
                 extra_system_parts=extra_parts,
                 mode_addendum=REALTIME_CHAT_ADDENDUM,
+                context_docs=context_docs,
             )
             yield from self._stream_llm(prompt, messages, question)
             logger.info("[REALTIME] Stream completed for: %s",search_query)
@@ -230,4 +289,4 @@ class RealtimeGroqService(GroqService):
             raise
         except Exception as e:
             logger.error("Enter in realtime stream_response: %s",e, exc_info=True)
-            raise
\ No newline at end of file
+            raise
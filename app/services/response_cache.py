@@ -0,0 +1,73 @@
+import logging
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger("J.A.R.V.I.S")
+
+
+class SemanticResponseCache:
+    """Reuses a previous answer when a new question is nearly identical in meaning.
+
+    Questions are embedded with the shared embedder, L2-normalized and kept in an exact
+    inner-product FAISS index, so the search score is cosine similarity. Entries expire
+    after ttl_seconds; the oldest are dropped once max_entries is reached.
+    """
+
+    def __init__(self, embeddings: Embeddings, threshold: float, ttl_seconds: float, max_entries: int = 1024):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._index: Optional[faiss.IndexFlatIP] = None
+        # Insertion order == age order, which keeps expiry a prefix trim.
+        self._entries: List[Tuple[np.ndarray, str, float]] = []
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = np.asarray([self.embeddings.embed_query(question)], dtype=np.float32)
+        faiss.normalize_L2(vector)
+        return vector
+
+    def _rebuild(self):
+        self._index = faiss.IndexFlatIP(self._entries[0][0].shape[1]) if self._entries else None
+        if self._index is not None:
+            self._index.add(np.vstack([vector for vector, _, _ in self._entries]))
+
+    def lookup(self, question: str) -> Optional[str]:
+        vector = self._embed(question)
+        with self._lock:
+            if self._index is None:
+                return None
+            scores, ids = self._index.search(vector, 1)
+            i = int(ids[0][0])
+            if i < 0 or scores[0][0] < self.threshold:
+                return None
+            _, response, created = self._entries[i]
+            if time.monotonic() - created > self.ttl_seconds:
+                return None
+        logger.info("[CACHE] Semantic cache hit (similarity %.3f)", scores[0][0])
+        return response
+
+    def store(self, question: str, response: str):
+        if not response:
+            return
+        vector = self._embed(question)
+        now = time.monotonic()
+        with self._lock:
+            keep_from = 0
+            while keep_from < len(self._entries) and now - self._entries[keep_from][2] > self.ttl_seconds:
+                keep_from += 1
+            keep_from = max(keep_from, len(self._entries) + 1 - self.max_entries)
+            if keep_from:
+                # FAISS flat indexes cannot drop rows cheaply; rebuild from the survivors.
+                del self._entries[:keep_from]
+                self._rebuild()
+            self._entries.append((vector, response, now))
+            if self._index is None:
+                self._index = faiss.IndexFlatIP(vector.shape[1])
+            self._index.add(vector)
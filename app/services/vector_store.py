@@ -1,11 +1,25 @@
-import json
+import os
 import logging
+import shutil
+import uuid
+import orjson
+import faiss
+import numpy as np
+import sqlite3
+import threading
+import hashlib
+import functools
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Optional
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 
 from config import (
     LEARNING_DATA_DIR,
@@ -14,65 +28,297 @@ from config import (
     EMBEDDING_MODEL,
     CHUNK_SIZE,
     CHUNK_OVERLAP,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_BACKEND,
+    EMBEDDING_ONNX_FILE,
+    OPENVINO_CACHE_DIR,
+    MODEL2VEC_MODEL,
+    EMBEDDING_THREADS,
+    EMBEDDING_THREADS_EXPLICIT,
 )
+from app.utils.text_file import read_text_mmap
 
 logger = logging.getLogger("J.A.R.V.I.S")
 
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+EMBED_BATCH_SIZE = 64
+
+# Below this many vectors an exact flat scan is already fast, and IVF/PQ training
+# would not have enough points (~39 per centroid) to produce good clusters.
+IVF_MIN_VECTORS = 10_000
+IVF_NLIST = 256
+IVF_PQ_M = 32
+IVF_NPROBE = 8
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """Wraps an embedder so repeated query strings skip the encoder.
+
+    Hits are served from an in-process LRU first, then from a small sqlite table
+    (keyed by sha256 of model name + text) so the cache survives restarts.
+    Document embedding is passed straight through.
+    """
+
+    def __init__(self, inner: Embeddings, cache_path: Path, namespace: str):
+        self.inner = inner
+        self._namespace = namespace
+        self._lock = threading.Lock()
+        try:
+            self._db = sqlite3.connect(str(cache_path), check_same_thread=False)
+            # WAL + NORMAL: a cache-miss commit appends to the log without an fsync on the
+            # request path. A crash can only lose recent entries, which are recomputed anyway.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+            )
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.warning("[VECTOR] Query embedding disk cache unavailable: %s", e)
+            self._db = None
+        self._embed_query_cached = functools.lru_cache(maxsize=QUERY_EMBEDDING_CACHE_SIZE)(self._embed_query)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return list(self._embed_query_cached(text))
+
+    def _embed_query(self, text: str) -> tuple:
+        key = hashlib.sha256(f"{self._namespace}\0{text}".encode("utf-8")).hexdigest()
+        if self._db is not None:
+            try:
+                with self._lock:
+                    row = self._db.execute(
+                        "SELECT vector FROM query_embeddings WHERE key = ?", (key,)
+                    ).fetchone()
+                if row:
+                    return tuple(array("d", row[0]))
+            except sqlite3.Error as e:
+                logger.warning("[VECTOR] Query embedding cache read failed: %s", e)
+
+        vector = tuple(self.inner.embed_query(text))
+
+        if self._db is not None:
+            try:
+                with self._lock:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO query_embeddings (key, vector) VALUES (?, ?)",
+                        (key, array("d", vector).tobytes()),
+                    )
+                    self._db.commit()
+            except sqlite3.Error as e:
+                logger.warning("[VECTOR] Query embedding cache write failed: %s", e)
+        return vector
+
+
+class Model2VecEmbeddings(Embeddings):
+    """Static (distilled) embeddings from model2vec: token lookup + mean pool, no attention."""
+
+    def __init__(self, model_name: str):
+        from model2vec import StaticModel
+
+        self.model = StaticModel.from_pretrained(model_name)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        vectors = np.asarray(self.model.encode(texts), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0].tolist()
+
+
+def _build_embedder() -> Embeddings:
+    if EMBEDDING_BACKEND == "model2vec":
+        logger.info("[VECTOR] Embedding backend: model2vec (%s)", MODEL2VEC_MODEL)
+        return Model2VecEmbeddings(MODEL2VEC_MODEL)
+
+    model_name = EMBEDDING_MODEL
+    model_kwargs = {"device": "cpu"}
+    threads = EMBEDDING_THREADS
+    export_openvino = False
+    if EMBEDDING_BACKEND == "onnx-int8":
+        import onnxruntime
+
+        # int8 matmuls (VNNI on AVX-512 CPUs) instead of fp32 PyTorch kernels.
+        # ORT sizes its pool from the host's core count; use the CPUs this process may actually run on.
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = EMBEDDING_THREADS
+        model_kwargs["backend"] = "onnx"
+        model_kwargs["model_kwargs"] = {"file_name": EMBEDDING_ONNX_FILE, "session_options": session_options}
+    elif EMBEDDING_BACKEND == "openvino":
+        model_kwargs["backend"] = "openvino"
+        model_kwargs["model_kwargs"] = {"ov_config": {"INFERENCE_NUM_THREADS": str(EMBEDDING_THREADS)}}
+        if (OPENVINO_CACHE_DIR / "openvino").is_dir():
+            model_name = str(OPENVINO_CACHE_DIR)
+        else:
+            export_openvino = True
+    else:
+        if EMBEDDING_BACKEND != "torch":
+            logger.warning("[VECTOR] Unknown EMBEDDING_BACKEND '%s', using torch", EMBEDDING_BACKEND)
+        import torch
+
+        if EMBEDDING_THREADS_EXPLICIT:
+            torch.set_num_threads(EMBEDDING_THREADS)
+        threads = torch.get_num_threads()
+    logger.info(
+        "[VECTOR] Embedding backend: %s (%s), %d threads",
+        model_kwargs.get("backend", "torch"), model_name, threads,
+    )
+    embedder = HuggingFaceEmbeddings(
+        model_name = model_name,
+        model_kwargs=model_kwargs,
+        encode_kwargs={"batch_size": EMBED_BATCH_SIZE, "normalize_embeddings": True},
+    )
+    if export_openvino:
+        # The first load converts the model to OpenVINO IR; keep it so later starts skip that.
+        try:
+            embedder._client.save_pretrained(str(OPENVINO_CACHE_DIR))
+            logger.info("[VECTOR] Cached OpenVINO model at %s", OPENVINO_CACHE_DIR)
+        except Exception as e:
+            logger.warning("[VECTOR] Could not cache OpenVINO model: %s", e)
+    return embedder
+
+
 class VectorStoreService:
 
     def __init__(self):
 
-        self.emeddings = HuggingFaceEmbeddings(
-            model_name = EMBEDDING_MODEL,
-            model_kwargs={"device":"cpu"}
+        self.emeddings = CachedQueryEmbeddings(
+            _build_embedder(),
+            cache_path=EMBEDDING_CACHE_PATH,
+            namespace=(
+                f"{MODEL2VEC_MODEL}|model2vec|normalized" if EMBEDDING_BACKEND == "model2vec"
+                else f"{EMBEDDING_MODEL}|{EMBEDDING_BACKEND}|normalized"
+            ),
         )
 
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=CHUNK_SIZE,
-            chunk_overlap=CHUNK_OVERLAP
-        )
+        self.text_splitter = self._build_text_splitter()
 
         self.vector_store: Optional[FAISS] = None
 
         self._retriever_cache: dict = {}
 
+        self._dirty = False
+
+
+    @staticmethod
+    def _build_text_splitter() -> RecursiveCharacterTextSplitter:
+        # Length is measured with the embedder's own tokenizer so chunks fill, but never
+        # overflow, its input window.
+        try:
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL)
+            return RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+                tokenizer, chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+            )
+        except Exception as e:
+            # ~4 characters per token for English text.
+            logger.warning("[VECTOR] Tokenizer unavailable (%s), chunking by characters", e)
+            return RecursiveCharacterTextSplitter(
+                chunk_size=CHUNK_SIZE * 4,
+                chunk_overlap=CHUNK_OVERLAP * 4,
+            )
+
+    @staticmethod
+    def _read_learning_file(file_path: Path) -> Optional[Document]:
+        try:
+            content = read_text_mmap(file_path)
+        except Exception as e:
+            logger.warning("could not load learning data file %s: %s",file_path, e)
+            return None
+        if not content:
+            return None
+        logger.info("[VECTOR] Loded learning data: %s (%d chars)", file_path.name, len(content))
+        return Document(page_content=content, metadata={"source": str(file_path.name)})
+
+    @staticmethod
+    def _read_chat_file(file_path: Path) -> Optional[Document]:
+        try:
+            chat_data = orjson.loads(file_path.read_bytes())
+            messages = chat_data.get("messages", [])
+
+            lines = []
+            for msg in messages:
+                speaker = "User" if msg.get("role") == "user" else "Assistant"
+                lines.append(f"{speaker}: {msg.get('content', '')}")
+            chat_content = "\n".join(lines)
+        except Exception as e :
+            logger.warning("Could not load chat history file %s: %s",file_path,e)
+            return None
+        if not chat_content.strip():
+            return None
+        logger.info("[VECTOR] Loaded learning data: %s (%d messages)", file_path.name, len(messages))
+        return Document(page_content=chat_content, metadata={"source":f"chat_{file_path.stem}"})
+
+    @staticmethod
+    def _read_all(reader, paths: List[Path]) -> List[Document]:
+        if not paths:
+            return []
+        # Reads are I/O-bound, so threads overlap the disk latency; map keeps the sorted order.
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4, len(paths))) as executor:
+            return [doc for doc in executor.map(reader, paths) if doc is not None]
 
     def load_learning_data(self) -> List[Document]:
-        documents = []
-        for file_path in sorted(LEARNING_DATA_DIR.glob("*txt")):
-            try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    content = f.read().strip()
-                    if content:
-                        documents.append(Document(page_content=content, metadata={"source": str(file_path.name)}))
-                        logger.info("[VECTOR] Loded learning data: %s (%d chars)", file_path.name, len(content))
-            except Exception as e:
-                logger.warning("could not load learning data file %s: %s",file_path, e)
+        # Empty files would be dropped after reading anyway; skip them before opening.
+        paths = [p for p in sorted(LEARNING_DATA_DIR.glob("*.txt")) if p.stat().st_size > 0]
+        documents = self._read_all(self._read_learning_file, paths)
         logger.info("[VECTOR] Total learning data files loded: %d",len(documents))
         return documents
         
     def load_chat_history(self) -> List[Document]:
-        documents = []
-        for file_path in sorted(CHATS_DATA_DIR.glob("*.json")):
-            try:
-                with open(file_path,"r", encoding="utf-8") as f:
-                    chat_data = json.load(f)
-                messages = chat_data.get("messages", [])
-
-                chat_content = "\n".join([
-                    f"User: {msg.get('content', '')}" if msg.get('role') == 'user'
-                    else f"Assistant: {msg.get('content','')}"
-                    for msg in messages
-                    ])
-
-                if chat_content.strip():
-                    documents.append(Document(page_content=chat_content, metadata={"source":f"chat_{file_path.stem}"}))
-                    logger.info("[VECTOR] Loaded learning data: %s (%d messages)", file_path.name, len(messages))
-            except Exception as e :
-                logger.warning("Could not load chat history file %s: %s",file_path,e)
+        documents = self._read_all(self._read_chat_file, sorted(CHATS_DATA_DIR.glob("*.json")))
         logger.info("[VECTOR] Total learning data files loded: %d",len(documents))
         return documents
 
+    def _embed_documents_matrix(self, texts: List[str]) -> np.ndarray:
+        inner = self.emeddings.inner
+        if isinstance(inner, HuggingFaceEmbeddings):
+            # SentenceTransformer.encode already sorts inputs by length before batching (so
+            # each batch pads to similar lengths) and restores the order; asking for numpy
+            # directly skips the float -> list -> float32 round trip for every vector.
+            return inner._client.encode(
+                texts, convert_to_numpy=True, show_progress_bar=False, **inner.encode_kwargs
+            )
+        if isinstance(inner, Model2VecEmbeddings):
+            return inner._encode(texts)
+        return np.asarray(inner.embed_documents(texts), dtype=np.float32)
+
+    def _build_quantized_store(self, texts: List[str], vectors: np.ndarray, metadatas: List[dict]) -> FAISS:
+        matrix = np.ascontiguousarray(vectors, dtype=np.float32)
+        faiss.normalize_L2(matrix)
+        d = matrix.shape[1]
+
+        if len(matrix) >= IVF_MIN_VECTORS and d % IVF_PQ_M == 0:
+            # 4-bit PQ codes scanned with SIMD lookup tables, probing only nprobe lists.
+            index = faiss.index_factory(d, f"IVF{IVF_NLIST},PQ{IVF_PQ_M}x4fs", faiss.METRIC_INNER_PRODUCT)
+            index.train(matrix)
+            index.nprobe = IVF_NPROBE
+            logger.info("[VECTOR] Using IVF-PQ fast-scan index (nlist=%d, nprobe=%d)", IVF_NLIST, IVF_NPROBE)
+        else:
+            # Exact scan over fp16 codes: half the bytes of a float32 flat index, no training needed.
+            index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+            logger.info("[VECTOR] Using fp16 scalar-quantized flat index")
+        index.add(matrix)
+
+        ids = [str(uuid.uuid4()) for _ in texts]
+        docstore = InMemoryDocstore({
+            doc_id: Document(page_content=text, metadata=metadata)
+            for doc_id, text, metadata in zip(ids, texts, metadatas)
+        })
+        return FAISS(
+            embedding_function=self.emeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=dict(enumerate(ids)),
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
+
     def create_vector_store(self) -> FAISS:
 
         learning_docs = self.load_learning_data()
@@ -83,14 +329,19 @@ class VectorStoreService:
 
         if not all_documents:
             self.vector_store = FAISS.from_texts(["NO data available yet."], self.emeddings)
+            self._dirty = False
             logger.info("[VECTOR] No documents found, created placeholder index")
 
         else:
             chunks = self.text_splitter.split_documents(all_documents)
-            logger.info("[VECTOR] Split into %d chunks (chunk_size=%d, overlap=%d)",
+            logger.info("[VECTOR] Split into %d chunks (chunk_size=%d tokens, overlap=%d)",
                     len(chunks),CHUNK_SIZE,CHUNK_OVERLAP)
             
-            self.vector_store = FAISS.from_documents(chunks,self.emeddings)
+            texts = [c.page_content for c in chunks]
+            metadatas = [c.metadata for c in chunks]
+            vectors = self._embed_documents_matrix(texts)
+            self.vector_store = self._build_quantized_store(texts, vectors, metadatas)
+            self._dirty = True
             logger.info("[VECTOR] FAISS index built successfully with %d vectors",len(chunks))
         
         self._retriever_cache.clear()
@@ -99,11 +350,22 @@ class VectorStoreService:
         return self.vector_store
     
     def save_vector_store(self):
-        if self.vector_store:
-            try:
-                self.vector_store.save_local(str(VECTOR_STORE_DIR))
-            except Exception as e:
-                logger.error("Failed to save vector store to disk: %s",e)
+        if not self.vector_store or not self._dirty:
+            return
+        tmp_dir = VECTOR_STORE_DIR.with_name(VECTOR_STORE_DIR.name + ".tmp")
+        old_dir = VECTOR_STORE_DIR.with_name(VECTOR_STORE_DIR.name + ".old")
+        try:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            self.vector_store.save_local(str(tmp_dir))
+            # Swap directories with renames so readers see either the old or the new index, never a partial one.
+            shutil.rmtree(old_dir, ignore_errors=True)
+            if VECTOR_STORE_DIR.exists():
+                os.replace(VECTOR_STORE_DIR, old_dir)
+            os.replace(tmp_dir, VECTOR_STORE_DIR)
+            shutil.rmtree(old_dir, ignore_errors=True)
+            self._dirty = False
+        except Exception as e:
+            logger.error("Failed to save vector store to disk: %s",e)
 
     def get_retriever(self, k: int = 10):
         if not self.vector_store:
@@ -1,4 +1,5 @@
 import logging 
+import random
 import time 
 from typing import TypeVar, Callable
 
@@ -10,6 +11,7 @@ def with_retry(
         fn:Callable[[],T],
         max_retries: int = 3,
         initial_delay: float = 1.0,
+        max_delay: float = 30.0,
 ) -> T:
     
     last_exception = None
@@ -22,6 +24,8 @@ def with_retry(
             last_exception = e
             if attempt == max_retries - 1:
                 raise
+            # Decorrelated jitter: callers that failed together (e.g. on a 429) retry at different times.
+            delay = min(max_delay, random.uniform(initial_delay, delay * 2))
             logger.warning(
                 "Attempt %s/%s failed (%s). Retrying in %.1fs: %s",
                 attempt + 1,
@@ -32,6 +36,5 @@ def with_retry(
             )
 
             time.sleep(delay)
-            delay *= 2
     
     raise last_exception
\ No newline at end of file
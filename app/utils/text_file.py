@@ -0,0 +1,30 @@
+import mmap
+import os
+from pathlib import Path
+
+_ASCII_WHITESPACE = frozenset(b" \t\n\r\x0b\x0c")
+
+
+def read_text_mmap(file_path: Path) -> str:
+    """
+    Read a UTF-8 text file through a read-only memory map and return it stripped.
+    The stripped region is decoded straight from a memoryview of the map, so no bytes
+    copy of the file is made next to the resulting str.
+    Line endings are normalized to "\n", like a text-mode open().
+    """
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start, end = 0, len(mm)
+            while start < end and mm[start] in _ASCII_WHITESPACE:
+                start += 1
+            while end > start and mm[end - 1] in _ASCII_WHITESPACE:
+                end -= 1
+            # The view must be released before the map closes, or close() raises BufferError.
+            with memoryview(mm) as view, view[start:end] as region:
+                text = str(region, "utf-8")
+    if "\r" in text:
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    # Catches non-ASCII whitespace (e.g. NBSP) at the edges; returns text itself when there is none.
+    return text.strip()
@@ -1,13 +1,22 @@
 import datetime
+import time
+from functools import lru_cache
+
+_TIME_FORMAT = (
+    "Current Real-Time Information: \n"
+    "Day: %A\n"
+    "Date: %d\n"
+    "Month: %B\n"
+    "Year: %Y\n"
+    "Time: %H hours, %M minutes, %S seconds\n"
+)
+
+
+@lru_cache(maxsize=1)
+def _format_time(second: int) -> str:
+    return datetime.datetime.fromtimestamp(second).strftime(_TIME_FORMAT)
+
 
 def get_time_information() -> str:
-    now = datetime.datetime.now()
-    return(
-        f"Current Real-Time Information: \n"
-        f"Day: {now.strftime('%A')}\n"
-        f"Date: {now.strftime('%d')}\n"
-        f"Month: {now.strftime('%B')}\n"
-        f"Year: {now.strftime('%Y')}\n"
-        f"Time: {now.strftime('%H')} hours, {now.strftime('%M')} minutes, {now.strftime('%S')} seconds\n" 
-
-    )
\ No newline at end of file
+    # The text only changes once a second, so requests within the same second share it.
+    return _format_time(int(time.time()))
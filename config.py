@@ -18,10 +18,18 @@ USAGE:
 """
 
 import os
+import sys
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import cache
 from pathlib import Path
+
 from dotenv import load_dotenv
 
+from app.utils.text_file import read_text_mmap
+
 # -----------------------------------------------------------------------------
 # LOGGING
 # -----------------------------------------------------------------------------
@@ -73,12 +81,15 @@ VECTOR_STORE_DIR.mkdir(parents=True, exist_ok=True)
 # If all keys fail, the user receives a clear error message.
 # Model determines which AI model to use (llama-3.3-70b-versatile is latest).
 
-def _load_groq_api_keys() -> list:
+@cache
+def get_groq_api_keys() -> tuple:
     """
-    Load all GROQ API keys from the environment.
+    Load all GROQ API keys from the environment (once; later calls reuse the result).
     Reads GROQ_API_KEY first, then GROQ_API_KEY_2, GROQ_API_KEY_3, ... until
     a number has no value. There is no upper limit on how many keys you can set.
-    Returns a list of non-empty key strings (may be empty if GROQ_API_KEY is not set).
+    Duplicate keys are dropped (first occurrence wins) so fallback never retries
+    the same key twice. Call get_groq_api_keys.cache_clear() after changing env.
+    Returns a tuple of non-empty key strings (may be empty if GROQ_API_KEY is not set).
     """
     keys = []
     # First key: GROQ_API_KEY (required in practice; validated when building services).
@@ -94,14 +105,21 @@ def _load_groq_api_keys() -> list:
             break
         keys.append(k)
         i += 1
-    return keys
+    # dict preserves insertion order, so this dedupes without reordering.
+    return tuple(dict.fromkeys(keys))
 
 
-GROQ_API_KEYS = _load_groq_api_keys()
+GROQ_API_KEYS = list(get_groq_api_keys())
 # Backward compatibility: single key name still used in docs; code uses GROQ_API_KEYS.
 GROQ_API_KEY = GROQ_API_KEYS[0] if GROQ_API_KEYS else ""
 GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
 
+# Hedged requests: if the current key has not answered after this many seconds,
+# the next key is tried in parallel and the first successful reply wins. A full
+# reply from a 70B model often takes ~1s, so a much lower value would send most
+# requests to two keys and burn quota twice.
+GROQ_HEDGE_DELAY_SECONDS = float(os.getenv("GROQ_HEDGE_DELAY_SECONDS", "1.5"))
+
 # ============================================================================
 # TAVILY API CONFIGURATION
 # ============================================================================
@@ -127,12 +145,52 @@ TTS_RATE = os.getenv("TTS_RATE", "+22%")
 # ============================================================================
 # Embeddings convert text into numerical vectors that capture meaning
 # We use HuggingFace's sentence-transformers model (runs locally, no API needed)
-# CHUNK_SIZE: How many characters to split documents into
-# CHUNK_OVERLAP: How many characters overlap between chunks (helps maintain context)
+# CHUNK_SIZE: How many tokens (embedding model's tokenizer) to split documents into
+# CHUNK_OVERLAP: How many tokens overlap between chunks (helps maintain context)
+# MiniLM reads at most 256 tokens per input; anything beyond that is silently cut
+# off, so chunks are sized in tokens to just fit the window (240 + special tokens).
 
 EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
-CHUNK_SIZE = 1000  # Characters per chunk
-CHUNK_OVERLAP = 200  # Overlap between chunks
+CHUNK_SIZE = 240  # Tokens per chunk
+CHUNK_OVERLAP = 32  # Overlap between chunks (tokens)
+
+# Which runtime executes the embedding model (EMBEDDING_BACKEND in .env):
+#   torch      - default PyTorch backend (no extra install).
+#   onnx-int8  - ONNX Runtime with the pre-quantized int8 weights shipped in the
+#                model repo. Roughly 2x faster on CPU; the default file targets
+#                AVX-512 VNNI CPUs (use onnx/model_quint8_avx2.onnx on older ones).
+#                Needs: pip install "sentence-transformers[onnx]"
+#   openvino   - OpenVINO runtime (fused kernels, fastest on Intel CPUs). The exported
+#                IR is cached under models/openvino/ so later starts skip the export.
+#                Needs: pip install "sentence-transformers[openvino]"
+#   model2vec  - Static distilled embeddings (MODEL2VEC_MODEL): a token lookup + mean
+#                pool, no transformer pass, so (re)indexing is orders of magnitude
+#                faster at some cost in retrieval quality. Queries use the same
+#                model because vectors from different models are not comparable.
+#                Needs: pip install model2vec
+# Vectors from different backends differ slightly, so the query cache is keyed by backend.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").strip().lower()
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_qint8_avx512_vnni.onnx")
+MODEL2VEC_MODEL = os.getenv("MODEL2VEC_MODEL", "minishlab/potion-base-8M")
+OPENVINO_CACHE_DIR = BASE_DIR / "models" / "openvino" / EMBEDDING_MODEL.rsplit("/", 1)[-1]
+# CPU threads for one encode call (torch intra-op threads, ONNX Runtime intra_op_num_threads
+# or OpenVINO INFERENCE_NUM_THREADS). Defaults to the CPUs this process may run on (affinity /
+# cpuset), not every core on the host; lower it (EMBEDDING_THREADS in .env) when several
+# workers share a machine so they do not oversubscribe the CPU. torch is only overridden when
+# the variable is set: its own default (physical cores) is already sensible.
+_EMBEDDING_THREADS_ENV = os.getenv("EMBEDDING_THREADS", "").strip()
+EMBEDDING_THREADS_EXPLICIT = bool(_EMBEDDING_THREADS_ENV)
+if EMBEDDING_THREADS_EXPLICIT:
+    EMBEDDING_THREADS = max(1, int(_EMBEDDING_THREADS_ENV))
+elif hasattr(os, "sched_getaffinity"):
+    EMBEDDING_THREADS = len(os.sched_getaffinity(0))
+else:
+    EMBEDDING_THREADS = os.cpu_count() or 1
+
+# Query embeddings are cached on disk (sqlite) so repeated questions skip the
+# encoder, even across restarts. Kept outside vector_store/ because that folder
+# is rewritten whenever the index is saved.
+EMBEDDING_CACHE_PATH = BASE_DIR / "database" / "embedding_cache.sqlite"
 
 # Maximum conversation turns (user+assistant pairs) sent to the LLM per request.
 # Older turns are kept on disk but not sent to avoid context/token limits.
@@ -142,6 +200,50 @@ MAX_CHAT_HISTORY_TURNS = 20
 # and abuse. ~32K chars ≈ ~8K tokens; keeps total prompt well under model limits.
 MAX_MESSAGE_LENGTH = 32_000
 
+# Chat JSON files are written compactly by default. Set PRETTY_SAVE=1 in .env to
+# indent them (easier to read by hand, slower to write for long conversations).
+PRETTY_SAVE = os.getenv("PRETTY_SAVE", "").strip().lower() in ("1", "true", "yes")
+
+# Semantic response cache (GENERAL mode only). When enabled, an opening question whose
+# embedding has cosine similarity >= SEMANTIC_CACHE_THRESHOLD with one answered in the
+# last SEMANTIC_CACHE_TTL_SECONDS gets the stored answer instead of a new LLM call.
+# Off by default: answers to time-sensitive questions ("what day is it") would be reused.
+# Follow-up messages are never cached, since their meaning depends on the conversation.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "").strip().lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", str(24 * 60 * 60)))
+
+
+# ============================================================================
+# FROZEN SNAPSHOT
+# ============================================================================
+# The environment-derived settings above, captured once at import in an immutable,
+# slotted object. Code that runs per request should read these (or the module
+# constants) instead of calling os.getenv again.
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    tavily_api_key: str = field(repr=False)  # keep the secret out of logs
+    tts_voice: str
+    tts_rate: str
+    embedding_model: str
+    chunk_size: int
+    chunk_overlap: int
+    max_history: int
+    max_msg_len: int
+
+
+CONFIG = Config(
+    tavily_api_key=TAVILY_API_KEY,
+    tts_voice=TTS_VOICE,
+    tts_rate=TTS_RATE,
+    embedding_model=EMBEDDING_MODEL,
+    chunk_size=CHUNK_SIZE,
+    chunk_overlap=CHUNK_OVERLAP,
+    max_history=MAX_CHAT_HISTORY_TURNS,
+    max_msg_len=MAX_MESSAGE_LENGTH,
+)
+
 # ============================================================================
 # JARVIS PERSONALITY CONFIGURATION
 # ============================================================================
@@ -207,11 +309,14 @@ You CANNOT (refuse briefly):
 """
 
 # Build final system prompt: assistant name and optional user title from ENV (no hardcoded names).
-_JARVIS_SYSTEM_PROMPT_BASE_FMT = _JARVIS_SYSTEM_PROMPT_BASE.format(assistant_name=ASSISTANT_NAME)
-if JARVIS_USER_TITLE:
-    JARVIS_SYSTEM_PROMPT = _JARVIS_SYSTEM_PROMPT_BASE_FMT + f"\n- When appropriate, you may address the user as: {JARVIS_USER_TITLE}"
-else:
-    JARVIS_SYSTEM_PROMPT = _JARVIS_SYSTEM_PROMPT_BASE_FMT
+# Built in one pass at import and interned, so every module shares the same string object
+# and equality checks against it (e.g. prompt-template cache keys) short-circuit on identity.
+_JARVIS_USER_TITLE_LINE = (
+    f"\n- When appropriate, you may address the user as: {JARVIS_USER_TITLE}" if JARVIS_USER_TITLE else ""
+)
+JARVIS_SYSTEM_PROMPT = sys.intern(
+    _JARVIS_SYSTEM_PROMPT_BASE.format(assistant_name=ASSISTANT_NAME) + _JARVIS_USER_TITLE_LINE
+)
 
 
 GENERAL_CHAT_ADDENDUM = """
@@ -231,6 +336,56 @@ LENGTH: Keep replies short by default. 1-2 sentences for simple questions. Only
 """
 
 
+def _read_context_file(file_path: Path) -> str:
+    """Read one learning data file; "" on failure (the error is logged)."""
+    try:
+        return read_text_mmap(file_path)
+    except Exception as e:
+        logger.warning("Could not load learning data file %s: %s", file_path, e)
+        return ""
+
+
+async def _read_context_file_async(file_path: Path) -> str:
+    """Read one learning data file on a worker thread so the event loop is not blocked."""
+    return await asyncio.to_thread(_read_context_file, file_path)
+
+
+# (key, text) from the last load_user_context call. The key lists every file's
+# (path, mtime_ns, size), so an unchanged folder costs one stat per file instead
+# of re-reading and re-joining everything.
+_USER_CONTEXT_CACHE = None
+
+
+def _user_context_key(text_files: list):
+    """Fingerprint of the learning data files, or None if any stat fails (skip the cache)."""
+    key = []
+    try:
+        for p in text_files:
+            st = p.stat()
+            key.append((str(p), st.st_mtime_ns, st.st_size))
+    except OSError:
+        return None
+    return tuple(key)
+
+
+async def load_user_context_async() -> str:
+    """
+    Async version of load_user_context(): all files are read concurrently.
+    gather() returns results in argument order, so the sorted file order is kept.
+    """
+    global _USER_CONTEXT_CACHE
+    text_files = sorted(LEARNING_DATA_DIR.glob("*.txt"))
+    key = _user_context_key(text_files)
+    if key is not None and _USER_CONTEXT_CACHE is not None and _USER_CONTEXT_CACHE[0] == key:
+        return _USER_CONTEXT_CACHE[1]
+
+    contents = await asyncio.gather(*[_read_context_file_async(p) for p in text_files])
+    text = "\n\n".join(c for c in contents if c)
+    if key is not None:
+        _USER_CONTEXT_CACHE = (key, text)
+    return text
+
+
 def load_user_context() -> str:
     """
     Load and concatenate the contents of all .txt files in learning_data.
@@ -239,22 +394,29 @@ def load_user_context() -> str:
     learning text (e.g. optional utilities). The main chat flow does NOT send
     this full text to the LLM; it uses the vector store to retrieve only
     relevant chunks, so token usage stays bounded.
+    Files are read concurrently on a small thread pool (this also works when
+    called from inside a running event loop, where asyncio.run would fail).
     Returns:
         str: Combined content from all .txt files, or "" if none exist or all fail to read.
     """
-    context_parts = []
+    global _USER_CONTEXT_CACHE
 
     # Sorted by path so the order is always the same across runs.
     text_files = sorted(LEARNING_DATA_DIR.glob("*.txt"))
+    if not text_files:
+        return ""
+
+    # Unchanged files (same mtime and size) -> return the text built last time.
+    key = _user_context_key(text_files)
+    if key is not None and _USER_CONTEXT_CACHE is not None and _USER_CONTEXT_CACHE[0] == key:
+        return _USER_CONTEXT_CACHE[1]
 
-    for file_path in text_files:
-        try:
-            with open(file_path, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                if content:
-                    context_parts.append(content)
-        except Exception as e:
-            logger.warning("Could not load learning data file %s: %s", file_path, e)
+    # map() yields results in input order, so the sorted order is preserved.
+    with ThreadPoolExecutor(max_workers=min(16, len(text_files))) as executor:
+        context_parts = [c for c in executor.map(_read_context_file, text_files) if c]
 
     # Join all file contents with double newline; empty string if no files or all failed.
-    return "\n\n".join(context_parts) if context_parts else ""
\ No newline at end of file
+    text = "\n\n".join(context_parts) if context_parts else ""
+    if key is not None:
+        _USER_CONTEXT_CACHE = (key, text)
+    return text
@@ -3,9 +3,18 @@ import uvicorn
 
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))  # Use Render's PORT, fallback to 8000 locally
+    # Auto-reload is opt-in (ENV=development) so deployments never run the file watcher.
+    development = os.getenv("ENV", "").strip().lower() == "development"
+    # Each worker is a separate process with its own in-memory sessions and embedding
+    # model, so more than one is opt-in via WEB_CONCURRENCY (not combinable with reload).
+    workers = 1 if development else int(os.getenv("WEB_CONCURRENCY", "1"))
     uvicorn.run(
         "app.main:app",
         host="0.0.0.0",                  # MUST be 0.0.0.0
         port=port,
-        reload=False                     # No reload on prod
+        loop="auto",                     # uvloop when installed (not on Windows), else asyncio
+        http="httptools",                # C HTTP parser
+        workers=workers,
+        # Models load in the app's lifespan, so the reloader process itself never imports them.
+        reload=development,              # No reload unless ENV=development
     )